@@ -20,13 +20,14 @@ WATCH_FLAG="${WATCH:-1}"          # 1=continuous, 0=one-shot
 INTERVAL_SEC="${INTERVAL:-10}"
 MIN_AGE_SEC="${MIN_AGE:-2}"
 QUALITY="${QUALITY:-95}"
+FINAL_OPTIMIZE="${FINAL_OPTIMIZE:-1}"  # 1=optimize Huffman tables of the final JPG (smaller, slower encode).
 FORCE_FLAG="${FORCE:-0}"      # 1=reprocess even if state says seen
 FIX_PERMS_FLAG="${FIX_PERMS:-0}"  # 1=try to fix ownership/permissions via docker (no sudo)
 
 # Performance throttling (lower impact on your PC; slower processing).
 CPU_LIMIT="${CPU_LIMIT:-0.5}"         # Docker CPU quota, e.g. 0.5, 1, 2. Use 0 to disable.
 CPU_SHARES="${CPU_SHARES:-128}"       # Relative CPU weight (1024 is default).
-THREADS="${THREADS:-1}"               # Limit threads used by numpy/onnx/imagemagick.
+THREADS="${THREADS:-1}"               # Limit threads used by numpy/onnx and the worker's I/O threads.
 INITIAL_SCAN="${INITIAL_SCAN:-1}"     # 1=process existing files on start, 0=only new/changed.
 
 # Notifications & startup behavior
@@ -39,6 +40,15 @@ EVENT_WATCH_FLAG="${EVENT_WATCH:-1}"  # 1=use inotify if available (instant), 0=
 
 USE_GPU_FLAG="${USE_GPU:-0}"      # 1=try GPU (needs NVIDIA toolkit)
 
+# Inference inside container
+BATCH_SIZE="${BATCH_SIZE:-8}"         # Images per U^2-Net forward pass (1=no batching).
+JOBS="${JOBS:-1}"                     # Image->JPG conversion processes (run alongside inference).
+MODEL="${MODEL:-u2net}"               # u2net | u2netp (small, fast) | u2net_human_seg | silueta
+QUANTIZE="${QUANTIZE:-0}"             # 1=int8-quantize the model once (CPU speedup; cached in ~/.u2net).
+TENSORRT="${TENSORRT:-0}"             # 1=prefer TensorRT FP16 if libnvinfer is installed (not in the GPU image; engine cached in ~/.u2net).
+CUDA_GRAPH="${CUDA_GRAPH:-0}"         # 1=replay inference as a CUDA graph (GPU only; experimental).
+CUDNN_EXHAUSTIVE="${CUDNN_EXHAUSTIVE:-0}" # 1=benchmark every cuDNN conv algorithm at startup (slow start).
+
 HOST_UID="$(id -u)"
 HOST_GID="$(id -g)"
 
@@ -96,9 +106,17 @@ DOCKER_RUN_ARGS=(
   -e "OPENBLAS_NUM_THREADS=${THREADS}"
   -e "MKL_NUM_THREADS=${THREADS}"
   -e "NUMEXPR_NUM_THREADS=${THREADS}"
-  -e "MAGICK_THREAD_LIMIT=${THREADS}"
+  -e "THREADS=${THREADS}"
   -e "INITIAL_SCAN=${INITIAL_SCAN}"
+  -e "FINAL_OPTIMIZE=${FINAL_OPTIMIZE}"
   -e "EVENT_WATCH=${EVENT_WATCH_FLAG}"
+  -e "BATCH_SIZE=${BATCH_SIZE}"
+  -e "JOBS=${JOBS}"
+  -e "MODEL=${MODEL}"
+  -e "QUANTIZE=${QUANTIZE}"
+  -e "TENSORRT=${TENSORRT}"
+  -e "CUDA_GRAPH=${CUDA_GRAPH}"
+  -e "CUDNN_EXHAUSTIVE=${CUDNN_EXHAUSTIVE}"
 )
 
 if [[ "${CPU_LIMIT}" != "0" && -n "${CPU_LIMIT}" ]]; then
@@ -139,6 +157,7 @@ RUN apt-get update && apt-get install -y --no-install-recommends \
   ca-certificates curl bzip2 \
     libglib2.0-0 libgl1 \
   inotify-tools \
+    libturbojpeg \
   && rm -rf /var/lib/apt/lists/*
 
 ENV MAMBA_ROOT_PREFIX=/opt/micromamba
@@ -148,9 +167,7 @@ RUN curl -Ls https://micro.mamba.pm/api/micromamba/linux-64/latest | tar -xvj bi
 
 RUN micromamba create -y -n app -c conda-forge python=3.12 pip \
   && micromamba run -n app python -m pip install --no-cache-dir -U pip \
-  && micromamba run -n app python -m pip install --no-cache-dir "rembg[gpu,cli]" Pillow \
-  && apt-get update && apt-get install -y --no-install-recommends imagemagick \
-  && rm -rf /var/lib/apt/lists/*
+  && micromamba run -n app python -m pip install --no-cache-dir "rembg[gpu,cli]" Pillow "PyTurboJPEG<2"
 
 ENTRYPOINT ["micromamba", "run", "-n", "app"]
 DOCKER
@@ -165,11 +182,11 @@ RUN apt-get update && apt-get install -y --no-install-recommends \
     libglib2.0-0 \
     libgl1 \
   inotify-tools \
-    imagemagick \
+    libturbojpeg0 \
   && rm -rf /var/lib/apt/lists/*
 
 RUN python -m pip install --no-cache-dir -U pip \
-  && python -m pip install --no-cache-dir "rembg[cpu,cli]" Pillow
+  && python -m pip install --no-cache-dir "rembg[cpu,cli]" Pillow "PyTurboJPEG<2"
 DOCKER
   fi
 
@@ -198,6 +215,15 @@ MIN_AGE_SEC="$3"
 QUALITY="$4"
 FORCE_FLAG="$5"
 EVENT_WATCH="${EVENT_WATCH:-1}"
+BATCH_SIZE="${BATCH_SIZE:-8}"
+JOBS="${JOBS:-1}"
+THREADS="${THREADS:-1}"
+FINAL_OPTIMIZE="${FINAL_OPTIMIZE:-1}"
+MODEL="${MODEL:-u2net}"
+QUANTIZE="${QUANTIZE:-0}"
+TENSORRT="${TENSORRT:-0}"
+CUDA_GRAPH="${CUDA_GRAPH:-0}"
+CUDNN_EXHAUSTIVE="${CUDNN_EXHAUSTIVE:-0}"
 
 DIR="/data"
 LAST_SCAN_FILE="$DIR/.removebg_last_scan"
@@ -214,37 +240,667 @@ write_last_scan() {
   printf '%s\n' "$1" > "$LAST_SCAN_FILE" 2>/dev/null || true
 }
 
+# Persistent rembg worker: the model is loaded once and the session is reused
+# for every file (a `rembg i` per file pays the whole model load each time).
+# JPG conversion runs in a process pool so it overlaps with inference.
+# Protocol: each job is four NUL-terminated fields <id> <src> <jpg> <out> (a
+# path can hold any byte but NUL) and an empty field closes the request; the
+# worker answers "<id>\tOK" or "<id>\tFAIL\t<stage>: <msg>" lines once per job.
+WORKER_PY="/tmp/removebg_worker.py"
+cat > "$WORKER_PY" <<'PY'
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+
+try:  # optional: SIMD JPEG codec; PIL is used when it is missing
+    from turbojpeg import TJPF_RGB, TJSAMP_420, TJSAMP_444, TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
+# U^2-Net preprocessing constants (same as rembg's U2netSession.predict).
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+SIZE = (320, 320)
+
+# rembg models that share the U^2-Net input above.
+MODELS = ("u2net", "u2netp", "u2net_human_seg", "silueta")
+
+
+def tensorrt_runtime():
+    """True if libnvinfer loads.
+
+    onnxruntime-gpu lists the TensorRT provider whether or not the TensorRT
+    runtime is installed, and only fails when the session is created.
+    """
+    import ctypes
+
+    for name in ("libnvinfer.so", "libnvinfer.so.10", "libnvinfer.so.8"):
+        try:
+            ctypes.CDLL(name)
+        except OSError:
+            continue
+        return True
+    return False
+
+
+def session_providers(tensorrt, cuda_graph, cudnn_exhaustive):
+    """Fastest available onnxruntime providers first, CPU always last."""
+    import onnxruntime as ort
+
+    available = ort.get_available_providers()
+    providers = []
+    tensorrt = tensorrt and "TensorrtExecutionProvider" in available
+    if tensorrt and not tensorrt_runtime():
+        print("TensorRT runtime (libnvinfer) not found, skipping", file=sys.stderr)
+        tensorrt = False
+    if tensorrt:
+        # U^2-Net has a static input shape, so the built engine is reusable;
+        # cache it next to the models (first build takes minutes).
+        home = os.environ.get("U2NET_HOME", os.path.expanduser("~/.u2net"))
+        cache = os.path.join(home, "trt_cache")
+        os.makedirs(cache, exist_ok=True)
+        options = {
+            "trt_fp16_enable": True,
+            "trt_engine_cache_enable": True,
+            "trt_engine_cache_path": cache,
+        }
+        if cuda_graph:
+            options["trt_cuda_graph_enable"] = True
+        providers.append(("TensorrtExecutionProvider", options))
+    if "CUDAExecutionProvider" in available:
+        # EXHAUSTIVE benchmarks every conv algorithm on the first run; the
+        # heuristic pick is close enough for U^2-Net and starts in seconds.
+        search = "EXHAUSTIVE" if cudnn_exhaustive else "HEURISTIC"
+        options = {"cudnn_conv_algo_search": search}
+        if cuda_graph:
+            options["enable_cuda_graph"] = "1"
+        providers.append(("CUDAExecutionProvider", options))
+    providers.append("CPUExecutionProvider")
+    return providers
+
+
+def create_session(model, quantize, tensorrt, cuda_graph, cudnn_exhaustive):
+    """Build the rembg session, optionally on a cached int8 copy of the model."""
+    from rembg import new_session
+    from rembg.sessions import sessions_class
+
+    kwargs = {}
+    if quantize:
+        session_class = next(sc for sc in sessions_class if sc.name() == model)
+        src = session_class.download_models()
+        dst = os.path.splitext(src)[0] + ".int8.onnx"
+        if not os.path.exists(dst):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            # ConvInteger kernels only take uint8 weights.
+            quantize_dynamic(src, dst + ".tmp", weight_type=QuantType.QUInt8)
+            os.replace(dst + ".tmp", dst)
+        model, kwargs = "u2net_custom", {"model_path": dst}
+
+    providers = session_providers(tensorrt, cuda_graph, cudnn_exhaustive)
+    try:
+        return new_session(model, providers=providers, **kwargs)
+    except Exception:
+        fallback = session_providers(False, False, cudnn_exhaustive)
+        if providers == fallback:
+            raise
+        traceback.print_exc()
+        print("TensorRT/CUDA graph unavailable, falling back", file=sys.stderr)
+        return new_session(model, providers=fallback, **kwargs)
+
+
+def flatten_on_white(rgb, alpha):
+    """Composite RGB on white through an 8-bit alpha: rgb*a + 255*(1-a).
+
+    Both arguments may be arrays or PIL images; returns an RGB uint8 array.
+    Integer math in uint16 (255*255 + 127 still fits), rounded to nearest;
+    no white buffer is allocated.
+    """
+    alpha = np.asarray(alpha, dtype=np.uint16)[..., None]
+    out = np.ascontiguousarray(rgb, dtype=np.uint16)
+    out *= alpha
+    alpha ^= 255  # 255 - a for 0..255
+    alpha *= 255
+    out += alpha
+    out += 127
+    out //= 255
+    return out.astype(np.uint8)
+
+
+_turbo = None
+
+
+def turbo():
+    """Shared TurboJPEG handle, or None without PyTurboJPEG/libturbojpeg."""
+    global _turbo
+    if _turbo is None:
+        try:
+            _turbo = TurboJPEG() if TurboJPEG is not None else False
+        except (OSError, RuntimeError):
+            _turbo = False
+    return _turbo or None
+
+
+def read_jpg(path):
+    """Decode a JPG file to an RGB uint8 array."""
+    tj = turbo()
+    if tj is not None:
+        with open(path, "rb") as f:
+            return tj.decode(f.read(), pixel_format=TJPF_RGB)
+    with Image.open(path) as im:
+        return np.asarray(im.convert("RGB"))
+
+
+def write_jpg(path, rgb, quality, optimize=False):
+    """Encode an RGB array or PIL image as a baseline JPG file.
+
+    Chroma is kept at full resolution (4:4:4) from quality 90 up, like
+    ImageMagick's default, and subsampled 4:2:0 below that.
+    TurboJPEG cannot optimize Huffman tables, so optimize=True goes to PIL.
+    """
+    full_chroma = quality >= 90
+    tj = turbo()
+    if tj is not None and not optimize:
+        data = tj.encode(
+            np.ascontiguousarray(rgb),
+            quality=quality,
+            pixel_format=TJPF_RGB,
+            jpeg_subsample=TJSAMP_444 if full_chroma else TJSAMP_420,
+        )
+        with open(path, "wb") as f:
+            f.write(data)
+        return
+    if isinstance(rgb, np.ndarray):
+        rgb = Image.fromarray(rgb)
+    rgb.save(
+        path,
+        format="JPEG",
+        quality=quality,
+        optimize=optimize,
+        progressive=False,
+        subsampling="4:4:4" if full_chroma else "4:2:0",
+    )
+
+
+def convert_to_jpg(src, dst, quality):
+    """Normalize any image to an upright RGB JPG, flattening alpha on white.
+
+    The result feeds both the model input and the full-resolution composite
+    that becomes the final JPG, so it uses the final chroma subsampling; it
+    is deleted afterwards, so only the second Huffman-optimization pass and
+    progressive encoding are skipped. A JPG that is already upright
+    RGB/grayscale is linked (or copied) as is.
+    """
+    with Image.open(src) as im:
+        if (
+            im.format == "JPEG"
+            and im.mode in ("RGB", "L")
+            and im.getexif().get(ExifTags.Base.Orientation, 1) == 1
+        ):
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copyfile(src, dst)
+            return
+        im = ImageOps.exif_transpose(im)
+        if im.mode.startswith("I"):
+            # 16/32-bit integer grayscale: convert() would clip, not scale.
+            px = np.asarray(im, dtype=np.int64) >> 8
+            im = Image.fromarray(px.clip(0, 255).astype(np.uint8))
+        if im.has_transparency_data:
+            rgba = np.asarray(im.convert("RGBA"))
+            rgb = flatten_on_white(rgba[..., :3], rgba[..., 3])
+        else:
+            rgb = im.convert("RGB")
+    write_jpg(dst, rgb, quality)
+
+
+class ConversionPool:
+    """Process pool for convert_to_jpg, rebuilt when a child process dies.
+
+    A child killed mid-job (e.g. by the OOM killer on a huge image) breaks
+    the whole executor; its pending jobs fail and the next submit starts a
+    fresh one instead of raising.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.executor = self._start()
+
+    def _start(self):
+        # forkserver: never fork the process once onnxruntime has started threads.
+        return ProcessPoolExecutor(
+            max_workers=self.jobs,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+
+    def submit(self, fn, *args):
+        try:
+            return self.executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.executor.shutdown(wait=False)
+            self.executor = self._start()
+            return self.executor.submit(fn, *args)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def pinned_zeros(shape):
+    """float32 zeros in page-locked host memory, or pageable without CUDA.
+
+    onnxruntime's Python API cannot allocate pinned memory, so ask cudart
+    directly; host->GPU copies from pinned memory skip a staging copy.
+    """
+    import ctypes
+
+    nbytes = int(np.prod(shape)) * 4
+    for name in ("libcudart.so", "libcudart.so.12", "libcudart.so.11.0"):
+        try:
+            cudart = ctypes.CDLL(name)
+        except OSError:
+            continue
+        cudart.cudaHostAlloc.argtypes = [
+            ctypes.POINTER(ctypes.c_void_p),
+            ctypes.c_size_t,
+            ctypes.c_uint,
+        ]
+        ptr = ctypes.c_void_p()
+        if cudart.cudaHostAlloc(ctypes.byref(ptr), nbytes, 0) != 0:
+            break
+        buf = (ctypes.c_float * (nbytes // 4)).from_address(ptr.value)
+        arr = np.ctypeslib.as_array(buf).reshape(shape)
+        arr[...] = 0
+        return arr
+    return np.zeros(shape, np.float32)
+
+
+class ModelRunner:
+    """Runs batches through the model, with I/O bound on the GPU under CUDA.
+
+    Batches are staged in host_input, allocated once (page-locked on CUDA).
+    On CUDA the input and output also live in device buffers allocated once
+    and every batch runs at full batch_size: addresses and shapes never
+    change, which is what CUDA graph replay (and a single TensorRT engine)
+    needs.
+    """
+
+    def __init__(self, session, batch_size):
+        self.session = session
+        self.inner = session.inner_session
+        self.input_name = self.inner.get_inputs()[0].name
+        self.output_name = self.inner.get_outputs()[0].name
+        self.batch_size = batch_size
+        if self.inner.get_inputs()[0].shape[0] == 1:
+            self.batch_size = 1  # model exported with a fixed batch dimension
+
+        shape = (self.batch_size, 3, *SIZE)
+        self.host_input = np.zeros(shape, np.float32)
+        self.binding = None
+        if "CUDAExecutionProvider" in self.inner.get_providers():
+            import onnxruntime as ort
+
+            self.host_input = pinned_zeros(shape)
+            self.gpu_input = ort.OrtValue.ortvalue_from_shape_and_type(
+                shape, np.float32, "cuda", 0
+            )
+            self.gpu_output = ort.OrtValue.ortvalue_from_shape_and_type(
+                (self.batch_size, 1, *SIZE), np.float32, "cuda", 0
+            )
+            self.binding = self.inner.io_binding()
+            self.binding.bind_ortvalue_input(self.input_name, self.gpu_input)
+            self.binding.bind_ortvalue_output(self.output_name, self.gpu_output)
+
+    def run(self, n):
+        """Raw model output (n, 1, 320, 320) for the first n staged inputs.
+
+        Slots past n still hold an earlier batch; their outputs are dropped.
+        """
+        if self.binding is None:
+            feed = {self.input_name: self.host_input[:n]}
+            return self.inner.run([self.output_name], feed)[0]
+
+        self.gpu_input.update_inplace(self.host_input)
+        self.inner.run_with_iobinding(self.binding)
+        return self.gpu_output.numpy()[:n]
+
+
+def stage_input(slot, im):
+    """Normalize one RGB image straight into a (3, 320, 320) float32 slot.
+
+    Same math as rembg's normalize, (x / max(x) - mean) / std, folded into
+    one multiply and one subtract per pixel; no float64 HWC intermediates.
+    """
+    px = np.asarray(im.resize(SIZE, Image.Resampling.LANCZOS)).transpose(2, 0, 1)
+    std = np.array(STD, np.float32)[:, None, None]
+    scale = 1 / (max(int(px.max()), 1) * std)
+    np.multiply(px, scale, out=slot)
+    slot -= np.array(MEAN, np.float32)[:, None, None] / std
+
+
+def predict_masks(runner, images):
+    """Predict one 320x320 mask per image with a single batched forward pass."""
+    for slot, im in zip(runner.host_input, images):
+        stage_input(slot, im)
+    preds = runner.run(len(images))[:, 0]
+
+    masks = []
+    for pred in preds:
+        lo, hi = pred.min(), pred.max()
+        pred = (pred - lo) / max(hi - lo, 1e-6)
+        masks.append(Image.fromarray((pred.clip(0, 1) * 255).astype(np.uint8)))
+    return masks
+
+
+def open_for_inference(path):
+    """Open a JPG for the model input only; returns (full size, small RGB image).
+
+    The model sees 320x320, so let libjpeg decode at 1/2, 1/4 or 1/8 scale
+    (the smallest that still covers 640x640) instead of at full resolution.
+    """
+    with Image.open(path) as im:
+        size = im.size
+        if im.format == "JPEG":
+            im.draft("RGB", (2 * SIZE[0], 2 * SIZE[1]))
+        return size, im.convert("RGB")
+
+
+def image_stage(exc):
+    """Reply stage for a per-image error.
+
+    "rembg" (remembered by the shell) for a bad image; "io" for filesystem
+    errors such as ENOSPC or EACCES, which carry an errno (PIL's decode
+    errors don't) and say nothing about the file.
+    """
+    return "io" if isinstance(exc, OSError) and exc.errno is not None else "rembg"
+
+
+def finish_job(jpg, dst, size, mask, quality, optimize):
+    """Full-resolution decode, composite on white and final encode for one job."""
+    rgb = read_jpg(jpg)
+    mask = mask.resize(size, Image.Resampling.LANCZOS)
+    write_jpg(dst, flatten_on_white(rgb, mask), quality, optimize)
+
+
+def run_batch(runner, writes, jobs, quality, optimize, reply):
+    """Run one batch; returns {future: job_id} for the finishing work.
+
+    jobs carry the read-ahead futures of their model inputs. Each job is
+    finished on the write-behind threads (libjpeg, NumPy and file I/O
+    release the GIL), a pool separate from the reads so the next batch's
+    decodes never queue behind this batch's full-resolution writes.
+    """
+    loaded = []
+    for job_id, jpg, dst, opened in jobs:
+        try:
+            size, small = opened.result()
+        except Exception as exc:
+            reply(job_id, exc, image_stage(exc))
+        else:
+            loaded.append((job_id, jpg, dst, size, small))
+    if not loaded:
+        return {}
+
+    try:
+        masks = predict_masks(runner, [small for *_, small in loaded])
+    except Exception as exc:
+        # Fails the whole batch (CUDA OOM, graph replay...), not one image.
+        traceback.print_exc()
+        for job_id, *_ in loaded:
+            reply(job_id, exc, "infer")
+        return {}
+
+    return {
+        writes.submit(finish_job, jpg, dst, size, mask, quality, optimize): job_id
+        for (job_id, jpg, dst, size, _), mask in zip(loaded, masks)
+    }
+
+
+def run_request(runner, pool, reads, writes, jobs, quality, optimize, reply):
+    """Convert every job in the pool and batch them into inference as they finish.
+
+    A converted JPG is queued for its model-input decode from the pool's
+    done callback, i.e. even while the main thread is busy with inference,
+    so batch k+1 is decoded while batch k is on the model.
+    """
+    pending = {}
+    opening = {}  # conversion future -> read future (None once taken)
+    lock = threading.Lock()
+
+    def read_ahead(future):
+        with lock:
+            if future not in opening and future.exception() is None:
+                jpg = pending[future][1]
+                opening[future] = reads.submit(open_for_inference, jpg)
+
+    for job_id, src, jpg, dst in jobs:
+        future = pool.submit(convert_to_jpg, src, jpg, quality)
+        pending[future] = (job_id, jpg, dst)
+        future.add_done_callback(read_ahead)
+
+    finishing = {}
+    batch = []
+    for future in as_completed(pending):
+        job_id, jpg, dst = pending[future]
+        try:
+            future.result()
+        except BrokenProcessPool as exc:
+            # Not necessarily this file's fault: report it as a worker
+            # failure so the shell does not remember it as bad.
+            reply(job_id, exc, "worker")
+            continue
+        except Exception as exc:
+            reply(job_id, exc, "jpg")
+            continue
+        # as_completed can wake up before the done callback has run.
+        read_ahead(future)
+        with lock:
+            opened, opening[future] = opening[future], None
+        batch.append((job_id, jpg, dst, opened))
+        if len(batch) == runner.batch_size:
+            finishing.update(
+                run_batch(runner, writes, batch, quality, optimize, reply)
+            )
+            batch = []
+    if batch:
+        finishing.update(run_batch(runner, writes, batch, quality, optimize, reply))
+
+    for future in as_completed(finishing):
+        try:
+            future.result()
+        except Exception as exc:
+            reply(finishing[future], exc, image_stage(exc))
+        else:
+            reply(finishing[future])
+
+
+def load_runner(args, cuda_graph):
+    """Create the session and its ModelRunner, then warm it up."""
+    session = create_session(
+        args.model,
+        args.quantize,
+        args.tensorrt,
+        cuda_graph,
+        args.cudnn_exhaustive,
+    )
+    print("Providers:", ", ".join(session.inner_session.get_providers()))
+    runner = ModelRunner(session, max(args.batch_size, 1))
+    # Warm up at full batch size so algorithm search, TensorRT engine load
+    # and CUDA graph capture happen before READY, not on the first image.
+    # onnxruntime captures the graph only after a couple of regular runs.
+    # On CPU there is nothing to warm up; it would only delay READY.
+    if runner.binding is not None:
+        for _ in range(3 if cuda_graph else 1):
+            runner.run(runner.batch_size)
+    return runner
+
+
+def read_requests(stream):
+    """Yield each request as a list of (id, src, jpg, dst) jobs.
+
+    Fields are NUL-terminated and an empty field closes the request; names
+    that are not valid UTF-8 round-trip through os.fsdecode.
+    """
+    fields, buf = [], b""
+    while chunk := stream.read1(65536):
+        buf += chunk
+        *done, buf = buf.split(b"\0")
+        for field in done:
+            if field:
+                fields.append(os.fsdecode(field))
+                continue
+            yield [tuple(fields[i : i + 4]) for i in range(0, len(fields) - 3, 4)]
+            fields = []
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--quality", type=int, default=95)
+    parser.add_argument("--final-optimize", action="store_true")
+    parser.add_argument("--model", choices=MODELS, default="u2net")
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--tensorrt", action="store_true")
+    parser.add_argument("--cuda-graph", action="store_true")
+    parser.add_argument("--cudnn-exhaustive", action="store_true")
+    args = parser.parse_args()
+
+    # stdout is the reply channel to the shell; keep library chatter off it.
+    replies = sys.stdout
+    sys.stdout = sys.stderr
+
+    def reply(job_id, exc=None, stage=""):
+        if exc is None:
+            print(f"{job_id}\tOK", file=replies, flush=True)
+        else:
+            msg = " ".join(str(exc).split()).encode(errors="replace").decode()
+            print(f"{job_id}\tFAIL\t{stage}: {msg}", file=replies, flush=True)
+
+    pool = ConversionPool(max(args.jobs, 1))
+    # Read-ahead and write-behind threads, throttled like the rest by THREADS.
+    reads = ThreadPoolExecutor(max_workers=max(args.threads, 1))
+    writes = ThreadPoolExecutor(max_workers=max(args.threads, 1))
+
+    try:
+        runner = load_runner(args, args.cuda_graph)
+    except Exception:
+        # Capture fails at run time, not at session creation, as soon as a
+        # node runs outside CUDA (e.g. the int8 model's ConvInteger).
+        if not args.cuda_graph:
+            raise
+        traceback.print_exc()
+        print("CUDA graph capture failed, falling back", file=sys.stderr)
+        runner = load_runner(args, False)
+    print("READY", file=replies, flush=True)
+
+    for jobs in read_requests(sys.stdin.buffer):
+        run_request(
+            runner,
+            pool,
+            reads,
+            writes,
+            jobs,
+            args.quality,
+            args.final_optimize,
+            reply,
+        )
+    reads.shutdown()
+    writes.shutdown()
+    pool.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+PY
+
+start_worker() {
+  local args=(--batch-size "$BATCH_SIZE" --jobs "$JOBS" --threads "$THREADS" --quality "$QUALITY" --model "$MODEL")
+  if [[ "$FINAL_OPTIMIZE" == "1" ]]; then
+    args+=(--final-optimize)
+  fi
+  if [[ "$QUANTIZE" == "1" ]]; then
+    args+=(--quantize)
+  fi
+  if [[ "$TENSORRT" == "1" ]]; then
+    args+=(--tensorrt)
+  fi
+  if [[ "$CUDA_GRAPH" == "1" ]]; then
+    args+=(--cuda-graph)
+  fi
+  if [[ "$CUDNN_EXHAUSTIVE" == "1" ]]; then
+    args+=(--cudnn-exhaustive)
+  fi
+  coproc WORKER { exec python "$WORKER_PY" "${args[@]}"; }
+  local reply=""
+  IFS= read -r -u "${WORKER[0]}" reply || true
+  if [[ "$reply" != "READY" ]]; then
+    echo "[FAIL] rembg worker did not start" >&2
+    exit 1
+  fi
+}
+
+ensure_worker() {
+  if [[ -z "${WORKER_PID:-}" ]] || ! kill -0 "$WORKER_PID" 2>/dev/null; then
+    start_worker
+  fi
+}
+
+# Takes the mtime already known to the caller; no stat/date forks here.
 is_stable() {
-  local p="$1"
-  local m
-  m="$(stat -c %Y "$p" 2>/dev/null || true)"
-  [[ -n "$m" ]] || return 1
+  local m="$1"
   local now
-  now="$(date +%s)"
+  printf -v now '%(%s)T' -1
   (( now - m >= MIN_AGE_SEC ))
 }
 
-process_one() {
+# Files waiting for the next worker request (same index in each array).
+# A whole scan or coalescing window goes out as one request so the worker
+# keeps converting while it runs inference on the batches already converted;
+# REQUEST_MAX only bounds the intermediates on disk and the wait for results.
+REQUEST_MAX=$(( BATCH_SIZE * 8 ))
+JOB_SRC=()
+JOB_MTIME=()
+JOB_STEM=()
+JOB_TMP=()
+JOB_KEY=()
+declare -A QUEUED
+
+# Args: path, mtime and size as listed by find. Event and retry callers
+# only know the path; the file is then stat'ed once here.
+queue_one() {
   local src="$1"
   local src_mtime_raw="$2"
+  local size="$3"
   local base stem ext mtime key
 
   # Avoid re-processing files we just wrote ourselves (important for inotify mode)
   local now
-  now="$(date +%s)"
+  printf -v now '%(%s)T' -1
   if [[ -n "${RECENT_WRITES["$src"]+x}" ]] && (( now < RECENT_WRITES["$src"] )); then
     return 0
   fi
 
-  base="$(basename -- "$src")"
-  mtime="${src_mtime_raw%.*}"
-  [[ -n "$mtime" ]] || mtime="$(stat -c %Y "$src" 2>/dev/null || true)"
-  [[ -n "$mtime" ]] || return 0
+  # Name checks are pure string matches and come before any stat.
+  base="${src##*/}"
 
   # Skip the state file and temp artifacts
-  if [[ "$base" == ".removebg_state.tsv" ]] || [[ "$base" == ".removebg_last_scan" ]] || [[ "$base" == *.tmp ]] || [[ "$base" == .tmp_removebg_* ]]; then
-    return 0
-  fi
+  case "$base" in
+    .removebg_state.tsv|.removebg_last_scan|*.tmp|.tmp_removebg_*)
+      return 0
+      ;;
+  esac
 
   # Only files that are likely images
   ext="${base##*.}"
@@ -256,84 +912,163 @@ process_one() {
       ;;
   esac
 
-  if ! is_stable "$src"; then
+  mtime="${src_mtime_raw%.*}"
+  if [[ -z "$mtime" ]]; then
+    key="$(stat -c '%Y:%s' "$src" 2>/dev/null || true)"
+    mtime="${key%%:*}"
+    size="${key#*:}"
+  fi
+  [[ -n "$mtime" ]] || return 0
+
+  if ! is_stable "$mtime"; then
+    # Too young (possibly still being written): try again later.
+    DEFERRED["$src"]=1
+    return 0
+  fi
+
+  # Already queued (several events for one file), or unchanged since we
+  # wrote it or since it last failed: nothing to do.
+  [[ -z "${QUEUED["$src"]+x}" ]] || return 0
+  key="$mtime:$size"
+  if [[ -n "${SEEN["$src"]+x}" && "${SEEN["$src"]}" == "$key" ]]; then
     return 0
   fi
 
   stem="${base%.*}"
-  local target="$DIR/$stem.jpg"
-  local tmp_jpg="$DIR/.tmp_removebg_${stem}_$$.jpg"
-  local tmp_png="$DIR/.tmp_removebg_${stem}_$$.png"
-  local tmp_out="$DIR/.tmp_removebg_${stem}_$$.out.jpg"
+  QUEUED["$src"]=1
+  JOB_SRC+=("$src")
+  JOB_MTIME+=("$mtime")
+  JOB_STEM+=("$stem")
+  JOB_KEY+=("$key")
+  # The queue index keeps tmp names unique when two sources share a stem.
+  JOB_TMP+=("$DIR/.tmp_removebg_${stem}_$$_${#JOB_TMP[@]}")
+
+  if (( ${#JOB_SRC[@]} >= REQUEST_MAX )); then
+    flush_jobs
+  fi
+}
 
-  cleanup_tmps() {
-    rm -f "$tmp_jpg" "$tmp_png" "$tmp_out" 2>/dev/null || true
-  }
+# Sends every queued file to the worker as one request, then finishes each.
+# The worker converts to JPG (flattening alpha on white), splits the request
+# into BATCH_SIZE inference batches as conversions complete, and writes the
+# final JPG (cut-out flattened on white).
+flush_jobs() {
+  local n="${#JOB_SRC[@]}"
+  (( n > 0 )) || return 0
+
+  local i reply rc=0
+  local lost=$'FAIL\tworker: rembg worker exited'
+  local -a status=()
+
+  ensure_worker
+  for (( i = 0; i < n; i++ )); do
+    printf '%s\0%s\0%s\0%s\0' "$i" "${JOB_SRC[i]}" "${JOB_TMP[i]}.jpg" "${JOB_TMP[i]}.out.jpg" >&"${WORKER[1]}"
+  done
+  printf '\0' >&"${WORKER[1]}"
+
+  for (( i = 0; i < n; i++ )); do
+    IFS= read -r -u "${WORKER[0]}" reply || break
+    status[${reply%%$'\t'*}]="${reply#*$'\t'}"
+  done
+
+  for (( i = 0; i < n; i++ )); do
+    finish_one "$i" "${status[i]:-$lost}" || rc=1
+  done
+
+  JOB_SRC=()
+  JOB_MTIME=()
+  JOB_STEM=()
+  JOB_TMP=()
+  JOB_KEY=()
+  QUEUED=()
+  return "$rc"
+}
 
-  # Convert/normalize to JPG (flatten alpha to white)
-  if ! magick "$src" -auto-orient -background white -alpha remove -quality "$QUALITY" "$tmp_jpg"; then
-    echo "[FAIL] $base (magick->jpg)" >&2
-    cleanup_tmps
-    return 1
-  fi
+finish_one() {
+  local i="$1"
+  local reply="$2"
+  local src="${JOB_SRC[i]}"
+  local mtime="${JOB_MTIME[i]}"
+  local base="${src##*/}"
 
-  # Remove background (outputs PNG with alpha)
-  local rembg_err
-  rembg_err="$(rembg i "$tmp_jpg" "$tmp_png" 2>&1)" || {
-    echo "[FAIL] $base (rembg)" >&2
-    printf '%s\n' "$rembg_err" | tail -n 40 >&2
-    cleanup_tmps
-    return 1
+  local target="$DIR/${JOB_STEM[i]}.jpg"
+  local tmp_jpg="${JOB_TMP[i]}.jpg"
+  local tmp_out="${JOB_TMP[i]}.out.jpg"
+
+  cleanup_tmps() {
+    rm -f "$tmp_jpg" "$tmp_out" 2>/dev/null || true
   }
-  if [[ ! -s "$tmp_png" ]]; then
-    echo "[FAIL] $base (rembg produced empty output)" >&2
-    cleanup_tmps
-    return 1
-  fi
 
-  # Convert output PNG to final JPG (flatten on white)
-  if ! magick "$tmp_png" -background white -alpha remove -quality "$QUALITY" "$tmp_out"; then
-    echo "[FAIL] $base (magick png->jpg)" >&2
+  # Worker converted to JPG, removed the background and flattened on white
+  if [[ "$reply" != "OK" ]]; then
+    local detail="${reply#FAIL$'\t'}"
+    echo "[FAIL] $base (${detail%%:*})" >&2
+    printf '%s\n' "${detail#*: }" >&2
     cleanup_tmps
+    # Remember only failures caused by the file itself; a worker crash or
+    # broken pool ("worker:"), a failed batch ("infer:") or a filesystem
+    # error ("io:") says nothing about it, so it stays retryable.
+    case "${detail%%:*}" in
+      jpg|rembg) SEEN["$src"]="${JOB_KEY[i]}" ;;
+    esac
     return 1
   fi
   if [[ ! -s "$tmp_out" ]]; then
-    echo "[FAIL] $base (magick produced empty output)" >&2
+    echo "[FAIL] $base (rembg produced empty output)" >&2
     cleanup_tmps
+    SEEN["$src"]="${JOB_KEY[i]}"
     return 1
   fi
 
   mv -f "$tmp_out" "$target"
 
-  rm -f "$tmp_jpg" "$tmp_png" 2>/dev/null || true
+  rm -f "$tmp_jpg" 2>/dev/null || true
 
   # Preserve original mtime so the watcher doesn't reprocess the same file.
   touch -d "@${mtime}" "$target" 2>/dev/null || true
 
   # Mark the target as recently written (so inotify doesn't loop)
-  RECENT_WRITES["$target"]=$(( $(date +%s) + MIN_AGE_SEC + 2 ))
-
-  # Delete original if it wasn't already the target
-  if command -v realpath >/dev/null 2>&1; then
-    if [[ "$(realpath "$src")" != "$(realpath "$target")" ]]; then
-      rm -f -- "$src" || true
-    fi
-  else
-    if [[ "$src" != "$target" ]]; then
-      rm -f -- "$src" || true
-    fi
+  local now
+  printf -v now '%(%s)T' -1
+  RECENT_WRITES["$target"]=$(( now + MIN_AGE_SEC + 2 ))
+  SEEN["$target"]="$(stat -c '%Y:%s' "$target" 2>/dev/null || true)"
+
+  # Delete original if it wasn't already the target. Both paths are built as
+  # "$DIR/<name>" (find and inotifywait list direct children only), so a
+  # string compare is enough; no realpath per file.
+  if [[ "$src" != "$target" ]]; then
+    rm -f -- "$src" || true
   fi
 
-  echo "[OK] $base -> $(basename -- "$target") (replaced)"
+  echo "[OK] $base -> ${target##*/} (replaced)"
+}
+
+# Files skipped for being younger than MIN_AGE_SEC. An inotify event only
+# fires once per write and a polling scan only lists files newer than the
+# last scan, so these are retried explicitly.
+retry_deferred() {
+  local p
+  for p in "${!DEFERRED[@]}"; do
+    unset 'DEFERRED[$p]'
+    queue_one "$p" "" "" || true
+  done
 }
 
 declare -A RECENT_WRITES
+declare -A DEFERRED
+# "mtime:size" of files we produced or that failed, so later scans (and FORCE
+# mode, which rescans everything) skip them until they change.
+declare -A SEEN
+
+trap 'rm -f "$DIR"/.tmp_removebg_*_$$_* 2>/dev/null || true' EXIT
+start_worker
 
 echo "Folder:   $DIR"
 echo "Mode:     in-place (replaces originals with .jpg)"
 echo "Watch:    $WATCH_FLAG (interval=${INTERVAL_SEC}s)"
 echo "Min age:  ${MIN_AGE_SEC}s"
 echo "Quality:  $QUALITY"
+echo "Model:    $MODEL (session loaded once, batch=${BATCH_SIZE}, int8=${QUANTIZE})"
 echo "Force:    $FORCE_FLAG"
 if [[ "$WATCH_FLAG" != "0" && "$EVENT_WATCH" == "1" && "$(command -v inotifywait || true)" != "" ]]; then
   echo "Watch impl: inotify (instant)"
@@ -350,21 +1085,40 @@ fi
 # If inotify is available, we can avoid polling and react instantly.
 if [[ "$WATCH_FLAG" != "0" && "$EVENT_WATCH" == "1" ]] && command -v inotifywait >/dev/null 2>&1; then
   if [[ "$INITIAL_SCAN" == "1" || "$FORCE_FLAG" == "1" ]]; then
-    while IFS= read -r -d '' p && IFS= read -r -d '' mt; do
-      process_one "$p" "$mt" || true
-    done < <(find "$DIR" -maxdepth 1 -type f -print0 -printf '%p\0%T@\0')
+    while IFS= read -r -d '' p && IFS= read -r -d '' mt && IFS= read -r -d '' sz; do
+      queue_one "$p" "$mt" "$sz" || true
+    done < <(find "$DIR" -maxdepth 1 -type f -printf '%p\0%T@\0%s\0')
+    flush_jobs || true
   fi
 
   echo "Waiting for changes (inotify)…"
-  inotifywait -m -e close_write,moved_to,create --format '%w%f' "$DIR" 2>/dev/null | \
-    while IFS= read -r p; do
-      process_one "$p" "" || true
-    done
+  # Process substitution (not a pipe) keeps the loop in this shell, where the
+  # worker's coproc file descriptors are still open. Events arriving within
+  # 200ms of each other are coalesced into one batch; with nothing queued or
+  # deferred the read blocks, so an idle watcher does not wake up at all.
+  while true; do
+    read_timeout=()
+    if (( ${#JOB_SRC[@]} > 0 || ${#DEFERRED[@]} > 0 )); then
+      read_timeout=(-t 0.2)
+    fi
+    if IFS= read -r "${read_timeout[@]}" p; then
+      queue_one "$p" "" "" || true
+    elif (( $? > 128 )); then
+      retry_deferred
+      flush_jobs || true
+    else
+      break
+    fi
+  done < <(inotifywait -m -e close_write,moved_to,create --format '%w%f' "$DIR" 2>/dev/null)
   exit 0
 fi
 
 while true; do
-  now="$(date +%s)"
+  printf -v now '%(%s)T' -1
+
+  if [[ "$WATCH_FLAG" != "0" ]]; then
+    retry_deferred
+  fi
 
   # In one-shot mode, we process all candidate files.
   # In watch mode, we only consider files modified since last_scan.
@@ -374,21 +1128,27 @@ while true; do
   fi
 
   if [[ "$cutoff" == "0" ]]; then
-    while IFS= read -r -d '' p && IFS= read -r -d '' mt; do
+    while IFS= read -r -d '' p && IFS= read -r -d '' mt && IFS= read -r -d '' sz; do
       if [[ "$WATCH_FLAG" == "0" ]]; then
-        process_one "$p" "$mt"
+        queue_one "$p" "$mt" "$sz"
       else
-        process_one "$p" "$mt" || true
+        queue_one "$p" "$mt" "$sz" || true
       fi
-    done < <(find "$DIR" -maxdepth 1 -type f -print0 -printf '%p\0%T@\0')
+    done < <(find "$DIR" -maxdepth 1 -type f -printf '%p\0%T@\0%s\0')
   else
-    while IFS= read -r -d '' p && IFS= read -r -d '' mt; do
+    while IFS= read -r -d '' p && IFS= read -r -d '' mt && IFS= read -r -d '' sz; do
       if [[ "$WATCH_FLAG" == "0" ]]; then
-        process_one "$p" "$mt"
+        queue_one "$p" "$mt" "$sz"
       else
-        process_one "$p" "$mt" || true
+        queue_one "$p" "$mt" "$sz" || true
       fi
-    done < <(find "$DIR" -maxdepth 1 -type f -newermt "@${cutoff}" -print0 -printf '%p\0%T@\0')
+    done < <(find "$DIR" -maxdepth 1 -type f -newermt "@${cutoff}" -printf '%p\0%T@\0%s\0')
+  fi
+
+  if [[ "$WATCH_FLAG" == "0" ]]; then
+    flush_jobs
+  else
+    flush_jobs || true
   fi
 
   if [[ "$WATCH_FLAG" != "0" ]]; then